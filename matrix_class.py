@@ -1,15 +1,180 @@
 import pickle
-from copy import deepcopy, copy
+from copy import deepcopy
+from collections import deque
+import heapq
 import numpy as np
 import scipy.sparse
 import nltk
-from itertools import permutations
+from itertools import permutations, count
 import os
 import os.path
 import math
 
 import sowe2bow as s2b
 
+# entry of a matrix quantized by DS_matrix.quantize_probs()
+# that represents probability 1
+_FIXED_POINT_ONE = 32767
+
+try:
+    import numba
+    _prange = numba.prange
+except ImportError:
+    # numba is optional, the kernels below then run as plain python
+    numba = None
+    _prange = range
+
+
+def _jit(**options):
+    """
+    Compile the decorated function with numba.njit(**options)
+    if numba is installed, otherwise leave it unchanged.
+    """
+
+    def decorate(func):
+        if numba is None:
+            return func
+        return numba.njit(**options)(func)
+
+    return decorate
+
+
+@_jit(cache=True)
+def _bigram_prob(indptr, indices, data, word_id, prev_id):
+    """
+    Return p(word|prev_word) from the arrays of a CSC bigram matrix
+    (equivalently, of its transpose in CSR format) with sorted indices,
+    using binary search in the column of prev_word.
+    """
+
+    start = indptr[prev_id]
+    end = indptr[prev_id + 1]
+    k = start + np.searchsorted(indices[start:end], word_id)
+
+    if k < end and indices[k] == word_id:
+        return data[k]
+
+    return 0.0
+
+
+@_jit(cache=True)
+def _best_expansions(indptr, indices, data, last_id, left_ids, beam_width):
+    """
+    Return the (at most) beam_width words of left_ids that are most
+    likely to follow last_id, together with their bigram probabilities.
+    The arrays are those of _bigram_prob(), left_ids must be sorted.
+    """
+
+    # all lookups share last_id, so search its column once for all words
+    start = indptr[last_id]
+    end = indptr[last_id + 1]
+    cols = indices[start:end]
+    pos = np.searchsorted(cols, left_ids)
+
+    probs = np.zeros(len(left_ids))
+    for i in range(len(left_ids)):
+        if pos[i] < end - start and cols[pos[i]] == left_ids[i]:
+            probs[i] = data[start + pos[i]]
+
+    order = np.argsort(-probs, kind="mergesort")[:beam_width]
+
+    return left_ids[order], probs[order]
+
+
+@_jit(cache=True, parallel=True,
+      fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+def _ppmi_kernel(indptr, indices, data, pw_arr, out):
+    """
+    Write the positive PMI of each stored entry of a CSC bigram matrix
+    into out, processing the columns in parallel.
+    """
+
+    for c in _prange(len(indptr) - 1):
+        for k in range(indptr[c], indptr[c + 1]):
+            pw = pw_arr[indices[k]]
+            pcw = data[k]
+            if pw > 0 and pcw > 0:
+                pmi = math.log2(pcw / pw)
+                if pmi > 0 and math.isfinite(pmi):
+                    out[k] = pmi
+                else:
+                    out[k] = 0.0
+            else:
+                out[k] = 0.0
+
+
+def _ppmi(indptr, indices, data, pw_arr):
+    """
+    Return the positive PMI for each stored entry of a CSC bigram matrix,
+    given by its indptr, indices and data arrays. The column of an entry
+    is the context word c, its row the word w and its value p(w|c), so the
+    entry is divided by the unigram probability pw_arr of its row.
+    Only the stored entries are touched, zeros are never materialized.
+    """
+
+    if len(indices) > 0 and indices.max() >= len(pw_arr):
+        raise Exception("Unigram probabilities don't cover all rows")
+
+    # float32 is precise enough for PMI values and halves the memory
+    ppmi = np.zeros(len(data), dtype=np.float32)
+
+    if numba is not None:
+        _ppmi_kernel(indptr, indices, data, pw_arr, ppmi)
+        return ppmi
+
+    row_pw = pw_arr[indices]
+    with np.errstate(over="ignore"):
+        # overflows become inf and are set to 0 below
+        np.divide(data, row_pw, out=ppmi, where=(row_pw > 0))
+
+    np.log2(ppmi, out=ppmi, where=(ppmi > 0))
+    np.maximum(ppmi, 0, out=ppmi)
+    ppmi[~np.isfinite(ppmi)] = 0
+
+    return ppmi
+
+
+def _alias_setup(probs):
+    """
+    Build the tables for sampling from the distribution probs
+    with Walker's alias method (in Vose's formulation).
+
+    Parameters
+    ----------
+    probs : np.ndarray
+        Probabilities of the k outcomes. They needn't sum to 1.
+
+    Return
+    ------
+    prob_table : np.ndarray
+        Probability of keeping outcome i once slot i was drawn.
+    alias_table : np.ndarray
+        Outcome to take instead of i otherwise.
+    """
+
+    k = len(probs)
+    scaled = probs * (k / probs.sum())
+    prob_table = np.ones(k)
+    alias_table = np.arange(k)
+
+    small = [i for i in range(k) if scaled[i] < 1]
+    large = [i for i in range(k) if scaled[i] >= 1]
+
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        prob_table[less] = scaled[less]
+        alias_table[less] = more
+        scaled[more] += scaled[less] - 1
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+
+    # whatever is left has probability 1 up to rounding errors
+
+    return prob_table, alias_table
+
 
 class DS_matrix:
     """Class holding a DS model.
@@ -24,10 +189,13 @@ class DS_matrix:
         transform the internal representation to the different types.
         Use tocsr() for efficiency in row slicing, 
         e.g. if you want to call get_vector() often.
-        Use tocsc() for efficiency in column slicing,
-        e.g. if you want to call generate_bigram_sentence().
-        Use todok() for efficiency in accessing individual probabilities,
-        e.g. if you want to call get_bigram_prob() often.
+        Use tocsc() for efficiency in column slicing.
+        get_bigram_prob(), generate_bigram_sentence() and
+        reconstruct_sent() don't depend on the representation:
+        they use the transposed matrix in CSR format, built on first use
+        (which doesn't copy the data if the matrix is a csc_matrix).
+        A matrix stored with save() is loaded as csr_matrix whose
+        arrays are memory-mapped from disk.
     vocab_order : dict(int)
         Maps each word in the vocabulary to the number
         of the row which contains that word.
@@ -40,10 +208,23 @@ class DS_matrix:
         Parameters
         ----------
         matrix_path : str
-            Filename of file containing an existing matrix.
+            Filename of file containing an existing matrix,
+            or directory containing a matrix stored with save().
             If it is None, the matrix will be initialized empty.
         """
-        if matrix_path is not None:
+        if matrix_path is not None and os.path.isdir(matrix_path):
+            # the arrays are only read from disk when they are accessed
+            # and the pages are shared between processes
+            arrays = [np.load(os.path.join(matrix_path, name + ".npy"),
+                              mmap_mode="r")
+                      for name in ("data", "indices", "indptr")]
+            with open(os.path.join(matrix_path, "dicts.pkl"),
+                      "rb") as dicts_file:
+                shape, unigram_probs, vocab_order = pickle.load(dicts_file)
+            self.matrix = scipy.sparse.csr_matrix(tuple(arrays), shape=shape)
+            self.unigram_probs = unigram_probs
+            self.vocab_order = vocab_order
+        elif matrix_path is not None:
             with open(matrix_path, "rb") as matrix_file:
                 components = pickle.load(matrix_file)
                 self.matrix = components[0]
@@ -54,6 +235,78 @@ class DS_matrix:
             self.vocab_order = dict()
             self.unigram_probs = dict()
 
+        self._cache_key = None
+        self._reset_caches()
+
+    def _reset_caches(self):
+        """
+        Drop everything derived from the matrix and the dictionaries.
+        """
+
+        # built on first use by _row_index(), _unigram_distribution(),
+        # _prev_index() and _alias_table()
+        self._id2word = None
+        self._unigram_arr = None
+        self._unigram_vec = None
+        self._csr_by_prev = None
+        self._alias_cache = dict()
+
+    def _check_caches(self):
+        """
+        Reset the caches if matrix, vocab_order or unigram_probs
+        were replaced (or the dictionaries changed size) since
+        the caches were built, e.g. by assigning the attributes
+        of a DS_matrix created empty.
+        """
+
+        key = (self.matrix, self.vocab_order, self.unigram_probs,
+               len(self.vocab_order), len(self.unigram_probs))
+        old_key = self._cache_key
+
+        if (old_key is None
+                or any(new is not old
+                       for new, old in zip(key[:3], old_key[:3]))
+                or key[3:] != old_key[3:]):
+            self._reset_caches()
+            self._cache_key = key
+
+    def _row_index(self):
+        """
+        Return the lookup arrays aligned with the rows of the matrix:
+        id2word holds the word of each row and
+        unigram_arr holds the unigram probability of each row.
+        Rows without a word (e.g. in matrices of predict vectors)
+        get None and probability 0, as do words without unigram probability.
+        Both are computed once.
+        """
+
+        self._check_caches()
+
+        if self._id2word is None:
+            num_rows = self.matrix.shape[0]
+
+            id2word = [None] * num_rows
+            for word, i in self.vocab_order.items():
+                id2word[i] = word
+
+            self._unigram_arr = np.fromiter(
+                (self.unigram_probs.get(w, 0) if w is not None else 0
+                 for w in id2word),
+                dtype=np.float64, count=num_rows)
+            self._id2word = id2word
+
+        return self._id2word, self._unigram_arr
+
+    def _wid(self, word):
+        """
+        Return the row id of word.
+        """
+
+        if word not in self.vocab_order:
+            raise Exception("Word not in matrix")
+
+        return self.vocab_order[word]
+
     def get_vector(self, word):
         """
         Return the vector that represents word.
@@ -73,7 +326,11 @@ class DS_matrix:
 
         pos = self.vocab_order[word]
 
-        return self.matrix[pos].toarray()
+        vector = self.matrix[pos].toarray()
+        if self.prob_scale() != 1:
+            vector = vector * self.prob_scale()
+
+        return vector
 
     def contains(self, word):
         """
@@ -95,7 +352,19 @@ class DS_matrix:
         prev_pos = self.vocab_order[prev_word]
         pos = self.vocab_order[word]
 
-        return self.matrix[pos, prev_pos]
+        return self._get_bigram_prob(pos, prev_pos)
+
+    def _get_bigram_prob(self, pos, prev_pos):
+        """
+        Return the probability p(word|prev_word)
+        given the row ids of word and prev_word.
+        """
+
+        by_prev = self._prev_index()
+        prob = _bigram_prob(by_prev.indptr, by_prev.indices, by_prev.data,
+                            pos, prev_pos)
+
+        return prob * self.prob_scale()
 
     def get_words(self):
         """
@@ -130,32 +399,30 @@ class DS_matrix:
 
         word = start_word
 
-        words = self.get_words()
+        words, unigram_vec = self._unigram_distribution()
 
         while word != "END$_":
 
             pos = self.vocab_order[word]
-            prob_list = self.matrix.getcol(pos).toarray().flatten()
+            table = self._alias_table(pos)
 
-            if sum(prob_list) == 0:
+            if table is None:
                 # deal with possible cases where a word was never
                 # seen as first word in bigram using backoff
                 # happens when model was trained using stopwords
-                prob_list = []
-                for next_word in words:
-                    prob = self.get_unigram_prob(next_word)
-                    prob_list.append(prob)
-
-                index = np.random.choice(range(len(words)), p=prob_list)
-                word = words[index]
-                while word == "START$_":
-                    # we don't want START$_ in the middle of the sentence
-                    index = np.random.choice(range(len(words)), p=prob_list)
-                    word = words[index]
-
+                # (START$_ has probability 0 in unigram_vec, since
+                # we don't want it in the middle of the sentence)
+                index = np.random.choice(len(words), p=unigram_vec)
             else:
-                index = np.random.choice(range(len(words)), p=prob_list)
-                word = words[index]
+                # sample among the nonzero entries of the column only
+                prob_table, alias_table, ids = table
+                i = np.random.randint(len(ids))
+                if np.random.random() < prob_table[i]:
+                    index = ids[i]
+                else:
+                    index = ids[alias_table[i]]
+
+            word = words[index]
 
             if word == "END$_":
                 break
@@ -164,6 +431,51 @@ class DS_matrix:
 
         return sentence
 
+    def _alias_table(self, pos):
+        """
+        Return the alias tables for sampling from p(.|word),
+        where word is the word in row pos, as (prob_table, alias_table, ids),
+        with ids holding the rows of the words that can follow word.
+        Return None if no word ever followed word.
+        The tables are built once per word and then cached.
+        """
+
+        self._check_caches()
+
+        if pos not in self._alias_cache:
+            by_prev = self._prev_index()
+            start = by_prev.indptr[pos]
+            end = by_prev.indptr[pos + 1]
+            probs = by_prev.data[start:end]
+
+            if start == end or probs.sum() == 0:
+                self._alias_cache[pos] = None
+            else:
+                prob_table, alias_table = _alias_setup(probs)
+                ids = by_prev.indices[start:end]
+                self._alias_cache[pos] = (prob_table, alias_table, ids)
+
+        return self._alias_cache[pos]
+
+    def _unigram_distribution(self):
+        """
+        Return the words ordered by their row together with
+        the unigram distribution over them, excluding START$_.
+        Both are computed once and then cached.
+        """
+
+        id2word, unigram_arr = self._row_index()
+
+        if self._unigram_vec is None:
+            probs = unigram_arr.copy()
+            if "START$_" in self.vocab_order:
+                probs[self.vocab_order["START$_"]] = 0
+            probs /= probs.sum()
+
+            self._unigram_vec = probs
+
+        return id2word, self._unigram_vec
+
     def get_sentence_prob(self, sentence):
         """
         Get the probability of a sentence according to the bigram model.
@@ -179,18 +491,52 @@ class DS_matrix:
             Probability of that sentence.
         """
 
-        prob = 1
-        prev_word = "START$_"
+        return math.exp(self.get_sentence_logprob(sentence))
+
+    def get_sentence_logprob(self, sentence):
+        """
+        Get the natural logarithm of the probability of a sentence
+        according to the bigram model. Unlike get_sentence_prob(),
+        this doesn't underflow to 0 for long sentences.
+
+        Parameter
+        ---------
+        sentence : [str]
+            Sentence of which to get the log probability.
+
+        Returns
+        -------
+        logprob : float
+            Log probability of that sentence, -inf if it contains
+            a bigram with probability 0.
+        """
+
+        logprob = 0.0
+        prev_pos = self._wid("START$_")
 
         for word in sentence:
             if word not in self.vocab_order:
                 continue
-            prob *= self.get_bigram_prob(word, prev_word)
-            prev_word = word
+            pos = self.vocab_order[word]
+            logprob += self._log_bigram_prob(pos, prev_pos)
+            prev_pos = pos
 
-        prob *= self.get_bigram_prob("END$_", prev_word)
+        logprob += self._log_bigram_prob(self._wid("END$_"), prev_pos)
 
-        return prob
+        return logprob
+
+    def _log_bigram_prob(self, pos, prev_pos):
+        """
+        Return log p(word|prev_word) given the row ids
+        of word and prev_word, -inf if the probability is 0.
+        """
+
+        prob = self._get_bigram_prob(pos, prev_pos)
+
+        if prob > 0:
+            return math.log(prob)
+
+        return float("-inf")
 
     def get_unigram_prob(self, word):
         """
@@ -227,19 +573,45 @@ class DS_matrix:
             Vector representing the words of the sentence.
         """
 
-        words = nltk.word_tokenize(sent)
-        vectors = []
+        return self.encode_sentences([sent])
+
+    def encode_sentences(self, sents):
+        """
+        Encode several sentences as sums of word vectors,
+        like encode_sentence() but in one sparse product for all of them.
+        Unknown words are ignored.
+
+        Parameter
+        ---------
+        sents : [str]
+            Sentences to be encoded.
 
-        for word in words:
-            if word.lower() in self.vocab_order:
-                vectors.append(self.get_vector(word.lower()))
+        Return
+        ------
+        encodings : np.ndarray
+            One row per sentence, representing the words of that sentence.
+        """
 
-        if len(vectors) == 0:
-            encoding = np.zeros((1, self.matrix.shape[1]))
-        else:
-            encoding = np.sum(vectors, axis=0)
+        sent_nums = []
+        rows = []
+        for i, sent in enumerate(sents):
+            for word in nltk.word_tokenize(sent):
+                word = word.lower()
+                if word in self.vocab_order:
+                    sent_nums.append(i)
+                    rows.append(self.vocab_order[word])
+
+        # counts[i, j] is how often the word of row j occurs in sentence i
+        # (duplicate entries are summed up)
+        shape = (len(sents), self.matrix.shape[0])
+        counts = scipy.sparse.csr_matrix(
+            (np.ones(len(rows)), (sent_nums, rows)), shape=shape)
 
-        return encoding
+        encodings = counts.dot(self.matrix.tocsr()).toarray()
+        if self.prob_scale() != 1:
+            encodings *= self.prob_scale()
+
+        return encodings
 
     def less_words_matrix(self, word_set, normalize=False):
         """
@@ -276,35 +648,26 @@ class DS_matrix:
         if "END$_" in self.vocab_order:
             word_set.add("END$_")
 
-        new_shape = (len(word_set), self.matrix.shape[1])
-        new_matrix.matrix = scipy.sparse.lil_matrix(new_shape)
+        word_list = list(word_set)
+        new_matrix.vocab_order = {word: i for i, word in enumerate(word_list)}
+        new_matrix.unigram_probs = {word: self.unigram_probs[word]
+                                    for word in word_list}
 
-        for i, word in enumerate(word_set):
-            new_matrix.vocab_order[word] = i
-            new_matrix.unigram_probs[word] = self.unigram_probs[word]
-
-            pos = self.vocab_order[word]
-            new_matrix.matrix[i] = self.matrix.getrow(pos)
+        rows = np.fromiter((self.vocab_order[word] for word in word_list),
+                           dtype=np.intp, count=len(word_list))
+        new_matrix.matrix = self.matrix.tocsr()[rows]
 
         new_matrix.tocsc()
 
         if normalize:
             # normalize probabilities
-            rows, columns = new_matrix.matrix.nonzero()
-            entry_dict = dict()
-            for row, col in zip(rows, columns):
-                if col in entry_dict.keys():
-                    entry_dict[col].append(row)
-                else:
-                    entry_dict[col] = [row]
-
-            for i, col in enumerate(columns):
-                if i % 1000 == 0:
-                    print(i)
-                prob_sum = new_matrix.matrix.getcol(col).sum()
-
-                for row in entry_dict[col]:
-                    new_matrix.matrix[row, col] /= prob_sum
+            matrix = new_matrix.matrix
+            matrix.data = matrix.data.astype(np.float64)
+            col_sums = np.asarray(matrix.sum(axis=0)).ravel()
+            col_sums[col_sums == 0] = 1
+            cols = np.repeat(np.arange(matrix.shape[1]),
+                             np.diff(matrix.indptr))
+            matrix.data /= col_sums[cols]
 
         return new_matrix
 
@@ -329,12 +692,46 @@ class DS_matrix:
     def todok(self):
         """
         Transform self.matrix to scipy.sparse.dok_matrix.
-        This is useful for accessing individual elements,
-        for example when get_bigram_prob() is called many times.
+        Note that get_bigram_prob() doesn't need this anymore,
+        since it uses binary search in the transposed CSR matrix.
         """
 
         self.matrix = self.matrix.todok()
 
+    def quantize_probs(self):
+        """
+        Store the probabilities in the matrix as 16 bit fixed-point
+        numbers, i.e. p is stored as round(p * 32767) in an int16 array.
+        This needs a quarter of the memory of float64.
+        Probabilities and vectors returned by the methods of the class
+        are scaled back (see prob_scale()), but they are rounded to
+        multiples of 1/32767, so results (e.g. of the bag-of-words
+        reconstruction) can differ from those of the original matrix.
+        """
+
+        if self.matrix.dtype == np.int16:
+            return
+
+        self.matrix = self.matrix.tocsr()
+        if self.matrix.nnz > 0 and (self.matrix.data.min() < 0
+                                    or self.matrix.data.max() > 1):
+            raise Exception("Matrix doesn't contain probabilities")
+
+        self.matrix.data = np.round(
+            self.matrix.data * _FIXED_POINT_ONE).astype(np.int16)
+        self._reset_caches()
+
+    def prob_scale(self):
+        """
+        Return the factor turning the entries of the matrix
+        into probabilities: 1 unless quantize_probs() was called.
+        """
+
+        if self.matrix.dtype == np.int16:
+            return 1.0 / _FIXED_POINT_ONE
+
+        return 1.0
+
     def reconstruct_sent(self, sent, beam_width=3):
         """
         Reconstruct a sentence using the DS model
@@ -361,74 +758,129 @@ class DS_matrix:
 
         print("reconstructed bag of words ...")
 
-        self.todok()
-
         # beam search
-        def start_word_prob(w):
-            self.get_bigram_prob(w, "START$_")
-
         if words == []:
             return ""
 
-        first_word = max(words, key=start_word_prob)
-        prob = start_word_prob(first_word)
-
-        queue = [([first_word], prob)]
-        curr_length = 1
+        if len(words) == 1:
+            return words[0]
+
+        # the search itself works on word ids and the raw arrays
+        # of the matrix with one row per previous word
+        by_prev = self._prev_index()
+        indptr = by_prev.indptr
+        indices = by_prev.indices
+        data = by_prev.data
+
+        word_ids = [self._wid(w) for w in words]
+        end_id = self._wid("END$_")
+
+        # the words left for a sequence are a bitmask over the positions
+        # in word_ids, since a bag of words can contain a word twice
+        word_slots = dict()
+        for i, w in enumerate(word_ids):
+            word_slots[w] = word_slots.get(w, 0) | (1 << i)
+
+        def remove_word(mask, w):
+            # clear the lowest bit of w that is still set
+            slots = mask & word_slots[w]
+            return mask ^ (slots & -slots)
+
+        def words_left(mask):
+            left = []
+            while mask:
+                low = mask & -mask
+                left.append(word_ids[low.bit_length() - 1])
+                mask ^= low
+            return left
+
+        # start with the word that most likely begins a sentence,
+        # which is the best single expansion of START$_
+        first_ids, first_probs = _best_expansions(
+            indptr, indices, data, self._wid("START$_"),
+            np.unique(np.array(word_ids, dtype=np.intp)), 1)
+        first_id = int(first_ids[0])
+        prob = float(first_probs[0])
+
+        first_mask = remove_word((1 << len(word_ids)) - 1, first_id)
+
+        # queue entries are [id_list, prob, mask] and are processed in FIFO
+        # order, prune_heap holds the same entries ordered by length and
+        # probability, consumed or pruned entries get id_list = None
+        queue = deque([[[first_id], prob, first_mask]])
+        queue_size = 1
+        prune_heap = []
+        tie_breaker = count()
         solutions = []
 
-        while queue != []:
-            word_list, prob_thus_far = queue.pop(0)
-            words_left = copy(words)
-            for w in word_list:
-                if w in words_left:
-                    words_left.remove(w)
-
-            last_word = word_list[-1]
-
-            if len(word_list) < len(words) - 1:
-
-                expansions = []
+        while queue:
+            entry = queue.popleft()
+            id_list, prob_thus_far, mask = entry
+            if id_list is None:
+                # entry was pruned
+                continue
+            entry[0] = None
+            queue_size -= 1
 
-                for w in set(words_left):
-                    prob = self.get_bigram_prob(w, last_word)
+            last_id = id_list[-1]
 
-                    expansions.append((w, prob))
+            if len(id_list) < len(word_ids) - 1:
 
-                if len(expansions) < beam_width:
-                    best_expansions = expansions
-                else:
-                    expansions.sort(key=(lambda t: t[1]), reverse=True)
-                    best_expansions = expansions[:beam_width]
+                left_ids = np.unique(np.array(words_left(mask), dtype=np.intp))
+                best_ids, best_probs = _best_expansions(
+                    indptr, indices, data, last_id, left_ids, beam_width)
 
-                for w, p in best_expansions:
-                    new_word_list = word_list + [w]
-                    new_prob = prob_thus_far * p
-                    queue.append((new_word_list, new_prob))
+                for w, p in zip(best_ids.tolist(), best_probs.tolist()):
+                    new_entry = [id_list + [w], prob_thus_far * p,
+                                 remove_word(mask, w)]
+                    queue.append(new_entry)
+                    queue_size += 1
+                    heap_key = (len(new_entry[0]), new_entry[1],
+                                next(tie_breaker))
+                    heapq.heappush(prune_heap, heap_key + (new_entry,))
 
-                    len_queue = len(queue)
-                    if len_queue > 10000:
+                    if queue_size > 10000:
                         # prune the queue to avoid memory problems
-                        # remove one of the first 1000 elements in order
-                        # to not accidentally remove all long sequences
-                        remove_el = min(queue[:1000], key=(lambda t: t[1]))
-                        queue.remove(remove_el)
+                        # remove the least probable of the shortest
+                        # sequences in order to not accidentally
+                        # remove all long sequences
+                        remove_el = heapq.heappop(prune_heap)[-1]
+                        while remove_el[0] is None:
+                            remove_el = heapq.heappop(prune_heap)[-1]
+                        remove_el[0] = None
+                        queue_size -= 1
             else:
                 # found full sentence
-                w = words_left[0]
+                w = word_ids[mask.bit_length() - 1]
 
                 new_prob = (prob_thus_far
-                            * self.get_bigram_prob(w, last_word)
-                            * self.get_bigram_prob("END$_", w))
-                sent = word_list + [w]
+                            * _bigram_prob(indptr, indices, data, w, last_id)
+                            * _bigram_prob(indptr, indices, data, end_id, w))
+                sent = id_list + [w]
 
                 solutions.append((sent, new_prob))
 
-        best_sent, _ = max(solutions, key=(lambda t: t[1]))
-        best_sent = ' '.join(best_sent)
+        best_ids, _ = max(solutions, key=(lambda t: t[1]))
+        id2word, _ = self._row_index()
+        best_sent = ' '.join(id2word[w] for w in best_ids)
 
         return best_sent
 
+    def _prev_index(self):
+        """
+        Return the transpose of the matrix in CSR format with sorted
+        indices, i.e. row i holds p(.|word i). Computed once.
+        """
+
+        self._check_caches()
+
+        if self._csr_by_prev is None:
+            by_prev = self.matrix.T.tocsr()
+            by_prev.sort_indices()
+            self._csr_by_prev = by_prev
+
+        return self._csr_by_prev
+
     def pmi_matrix(self, new_matrix_path):
         """
         Calculate positive PMI for each pair of words
@@ -440,41 +892,48 @@ class DS_matrix:
             Directory to save the new matrix to.
         """
 
-        shape = self.matrix.shape
-        pmi_matrix = scipy.sparse.lil_matrix(shape, dtype=np.float64)
+        matrix = self.matrix.tocsc()
+        probs = matrix.data
+        if self.prob_scale() != 1:
+            probs = probs * self.prob_scale()
+        _, unigram_arr = self._row_index()
+        data = _ppmi(matrix.indptr, matrix.indices, probs, unigram_arr)
+
+        # ppmi(c, w) is stored in row c, so the CSC arrays of the
+        # input are read as the CSR arrays of the transposed output
+        shape = (matrix.shape[1], matrix.shape[0])
+        pmi_matrix = scipy.sparse.csr_matrix(
+            (data, matrix.indices.copy(), matrix.indptr.copy()), shape=shape)
+        # entries with negative PMI are 0 now and needn't be stored
+        pmi_matrix.eliminate_zeros()
+        pmi_matrix = pmi_matrix.tocsc()
 
-        self.tocsc()
+        with open(new_matrix_path, "wb") as new_matrix_file:
+            components = (pmi_matrix, self.unigram_probs, self.vocab_order)
+            pickle.dump(components, new_matrix_file)
 
-        i = 0
-        for word1 in self.vocab_order:
-            if i % 500 == 0:
-                print(i)
-            i += 1
-            #pc = self.unigram_probs[word1]
-            posc = self.vocab_order[word1]
-            probsc = self.matrix.getcol(posc).toarray().flatten()
+    def save(self, matrix_dir):
+        """
+        Store the matrix so that it can be memory-mapped when loaded:
+        the CSR arrays are saved as .npy files and the dictionaries
+        are pickled, all in one directory.
 
-            for word2 in self.vocab_order:
-                pw = self.unigram_probs[word2]
-                posw = self.vocab_order[word2]
-                pcw = probsc[posw]
-                
-                if pw == 0:
-                    inner = 0
-                else:
-                    inner = pcw / pw
-                if inner > 0:
-                    pmi = math.log(inner, 2)
-                    ppmi = max(pmi, 0)
-                else:
-                    ppmi = 0
+        Parameters
+        ----------
+        matrix_dir : str
+            Directory to save the matrix to. It is created if necessary.
+            Pass it to DS_matrix() to load the matrix again.
+        """
 
-                if ppmi == float("Inf") or ppmi == float("nan"):
-                    ppmi = 0
+        os.makedirs(matrix_dir, exist_ok=True)
 
-                pmi_matrix[posc, posw] = ppmi
-        pmi_matrix.tocsc()
+        matrix = self.matrix.tocsr(copy=True)
+        matrix.sum_duplicates()
 
-        with open(new_matrix_path, "wb") as new_matrix_file:
-            components = (pmi_matrix, self.unigram_probs, self.vocab_order)
-            pickle.dump(components, new_matrix_file)
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(matrix_dir, name + ".npy"),
+                    getattr(matrix, name))
+
+        with open(os.path.join(matrix_dir, "dicts.pkl"), "wb") as dicts_file:
+            components = (matrix.shape, self.unigram_probs, self.vocab_order)
+            pickle.dump(components, dicts_file)
@@ -71,11 +71,14 @@ def score_possible_additions(LL, target, end_point):
 
     word_scores = dict()
     matrix = LL.matrix.tocsr()
+    # turns entries of a quantized matrix into probabilities,
+    # see DS_matrix.quantize_probs()
+    scale = LL.prob_scale()
 
     for i, word in enumerate(LL.get_words()):
         pos = LL.vocab_order[word]
 
-        vec = matrix[pos].toarray()
+        vec = matrix[pos].toarray() * scale
         vec += diff
         vec = vec * vec
         s = np.sum(vec)